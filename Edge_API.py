@@ -1,12 +1,98 @@
 import streamlit as st
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import asyncio
+import io
 from datetime import datetime, time, timezone, timedelta
+import bisect
+import functools
+import hashlib
+import hmac
 import json
+import random
+import threading
+import orjson
 
 # --- Page and Session State Configuration ---
 st.set_page_config(page_title="Edge API Data Downloader", layout="wide")
 
+# --- Endpoint Configuration ---
+ENDPOINTS = {
+    "Devices": {
+        "path": "/devices",
+        "description": "Returns device details based on the API Key and optional device serial ID.",
+        "params": ["device_serialid"],
+        "required_params": [] 
+    },
+    "Events Interval": {
+        "path": "/events/interval/",
+        "description": "Returns event details based on the device_serialid provided within the time stamps.",
+        "params": ["device_serialid", "dates"],
+        "required_params": ["device_serialid"]
+    },
+    "Power Quality Live": {
+        "path": "/powerquality/live/",
+        "description": "Returns live power quality based on the serialid provided.",
+        "params": ["device_serialid"],
+        "required_params": ["device_serialid"],
+        "cache_ttl": 0
+    },
+    "Power Quality Interval": {
+        "path": "/powerquality/interval/",
+        "description": "Returns power quality data based on the provided serialid and the time stamps.",
+        "params": ["device_serialid", "dates", "granularity"],
+        "required_params": ["device_serialid", "granularity"],
+        "parquet_download": True,
+        "split_windows": True
+    },
+    "Power Quality Aggregated": {
+        "path": "/powerquality/aggregated/",
+        "description": "Returns aggregated power quality data based on the provided serialid and the time stamps.",
+        "params": ["device_serialid", "dates", "granularity"],
+        "required_params": ["device_serialid", "granularity"],
+        "parquet_download": True
+    }
+}
+
+BASE_URL = "https://v3.edgezeroapi.com/pienergy"
+# Query parameters filled in by each entry of an endpoint's "params" list.
+PARAM_KEYS = {"dates": ("starttime", "endtime"), "granularity": ("granularity",)}
+
+# Seconds a fetched result is reused; endpoints can override it with "cache_ttl" (0 disables caching).
+CACHE_TTL_SECONDS = 300
+
+# Granularity choices by date range: each tier applies from its day count up to the next one.
+GRANULARITY_TIERS = [
+    (0, ("1m", "5m", "15m", "1h", "daily")),
+    (1, ("15m", "1h", "daily")),
+    (8, ("1h", "daily")),
+]
+GRANULARITY_THRESHOLDS = [days for days, _ in GRANULARITY_TIERS]
+
+# --- Request Size Limits ---
+ROWS_PER_DAY = {"1m": 1440, "5m": 288, "15m": 96, "1h": 24, "daily": 1}
+MAX_EXPECTED_ROWS = 500_000
+# Sub-window length in seconds used to split long interval requests into concurrent calls.
+WINDOW_SECONDS = {"1m": 86400, "5m": 3 * 86400, "15m": 7 * 86400, "1h": 30 * 86400}
+
+# --- Lazy Imports ---
+# pandas and pyarrow are only needed after login, so the login form renders without importing them.
+@st.cache_resource
+def _pd():
+    """Imports pandas on first use after login."""
+    import pandas
+    return pandas
+
+@st.cache_resource
+def _pa():
+    """Imports pyarrow with the csv and parquet submodules used for the downloads."""
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.parquet
+    return pyarrow
+
 # --- Helper Function for Logging ---
 def log_error(error_message):
     """Prints a timestamped error message to the console/log."""
@@ -14,112 +100,355 @@ def log_error(error_message):
     # On Streamlit Cloud, print statements will appear in the log viewer.
     print(f"{timestamp} - ERROR: {error_message}")
 
+# --- Helper Functions for Concurrent Fetching ---
+MAX_CONCURRENT_REQUESTS = 8
+RETRY_STATUSES = (429, 502, 503, 504)
+MAX_ATTEMPTS = 5
+
+def backoff_delay(attempt):
+    """Returns the exponential backoff with jitter, in seconds, before retrying after the given attempt."""
+    return (2 ** attempt) * 0.2 + random.random() * 0.1
+
+class BackoffRetry(Retry):
+    """urllib3 Retry that waits on the same backoff_delay schedule as the concurrent fetches."""
+    def get_backoff_time(self):
+        return backoff_delay(len(self.history) - 1) if self.history else 0
+
+async def fetch_one(session, semaphore, url, params):
+    """Fetches a single URL within the shared session, retrying rate-limited calls, and returns the raw body."""
+    async with semaphore:
+        for attempt in range(MAX_ATTEMPTS):
+            async with session.get(url, params=params) as response:
+                if response.status not in RETRY_STATUSES or attempt == MAX_ATTEMPTS - 1:
+                    body = await response.read()
+                    if not response.ok:
+                        # Read the body before raising so the API's message reaches the error display.
+                        error = aiohttp.ClientResponseError(
+                            response.request_info, response.history,
+                            status=response.status, message=response.reason, headers=response.headers,
+                        )
+                        error.api_message = api_error_message(body)
+                        raise error
+                    return body
+            # The slot is held while backing off so a throttled API sees fewer calls.
+            await asyncio.sleep(backoff_delay(attempt))
+
+def api_error_message(body):
+    """Returns the 'message' field of an API error body, or the raw text if it is not a JSON object."""
+    text = body.decode('utf-8', errors='replace')
+    try:
+        error_json = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return text
+    return error_json.get('message', text) if isinstance(error_json, dict) else text
+
+async def _gather(fetch_requests, headers):
+    """Fetches all (url, params) pairs concurrently under one ClientSession and decodes the JSON bodies."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(limit=16)
+    # Match the 60s timeout used on the single-request path instead of aiohttp's 300s default.
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout) as session:
+        # A failed request comes back as its exception so the other requests in the batch still load.
+        bodies = await asyncio.gather(*[fetch_one(session, semaphore, url, params) for url, params in fetch_requests],
+                                      return_exceptions=True)
+    # Decoding happens after the fan-out so it never holds a concurrency slot.
+    return [decode_body(body) for body in bodies]
+
+def decode_body(body):
+    """Decodes a JSON response body, passing a failed request's exception through unchanged."""
+    if isinstance(body, Exception):
+        return body
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        return e
+
+def request_error_messages(error):
+    """Describes a failed request as error lines, including the API's own message when it sent one."""
+    if isinstance(error, requests.exceptions.HTTPError):
+        return [f"HTTP Error: {error}", f"API Response: {api_error_message(error.response.content)}"]
+    if isinstance(error, aiohttp.ClientResponseError):
+        messages = [f"HTTP Error: {error.status} {error.message} for url: {error.request_info.real_url}"]
+        if hasattr(error, 'api_message'):
+            messages.append(f"API Response: {error.api_message}")
+        return messages
+    return [f"Request failed: {str(error) or type(error).__name__}"]
+
 # Initialize session state for login status if it doesn't exist
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
 
+def api_headers(api_key):
+    """Returns the headers sent with every Edge API request, shared by the requests and aiohttp paths."""
+    # Brotli is decoded transparently by urllib3 and aiohttp when the brotli package is installed.
+    return {"X-Api-Key": api_key, "accept": "*/*", "Accept-Encoding": "br, gzip"}
+
+def get_http_session(api_key):
+    """Returns the pooled requests.Session for this user, creating it on first use."""
+    if "http" not in st.session_state:
+        session = requests.Session()
+        # Like fetch_one, only the retryable statuses are retried, with the same attempts and backoff; connect and
+        # read errors fail at once on both paths, and Retry-After is ignored so waits stay bounded.
+        # The last response is returned once retries run out so its API message can be shown.
+        retries = BackoffRetry(total=None, connect=0, read=0, status=MAX_ATTEMPTS - 1, status_forcelist=RETRY_STATUSES,
+                               allowed_methods=["GET"], respect_retry_after_header=False, raise_on_status=False)
+        session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retries))
+        session.headers.update(api_headers(api_key))
+        st.session_state.http = session
+    return st.session_state.http
+
+@st.cache_resource
+def _frame_cache():
+    """Returns the process-wide store of fetched frames and the lock guarding it."""
+    # {(request_key, api_key_hash): (expires_at, df, api_errors)}, shared by all sessions like st.cache_data.
+    return {}, threading.Lock()
+
+def fetch_dfs(request_groups, api_key, cache_ttls, force_refresh=False):
+    """Returns a (DataFrame, API errors) pair per request group, fetching every group not cached in one batch."""
+    # Entries are keyed on a hash of the API key, never the raw key.
+    api_key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+    cache, lock = _frame_cache()
+    now = datetime.now().timestamp()
+    with lock:
+        for key in [key for key, entry in cache.items() if entry[0] <= now]:
+            del cache[key]
+        frames = {} if force_refresh else {
+            request_key: cache[(request_key, api_key_hash)][1:]
+            for request_key in request_groups if (request_key, api_key_hash) in cache
+        }
+
+    pending = [request_key for request_key in dict.fromkeys(request_groups) if request_key not in frames]
+    if pending:
+        cache_ttl_by_key = dict(zip(request_groups, cache_ttls))
+        for request_key, results in zip(pending, fetch_results(pending, api_key)):
+            frames[request_key] = frame = results_to_df(results)
+            # Groups with a failed request are fetched again on the next click instead of being cached.
+            if cache_ttl_by_key[request_key] > 0 and not any(isinstance(result, Exception) for result in results):
+                with lock:
+                    cache[(request_key, api_key_hash)] = (now + cache_ttl_by_key[request_key], *frame)
+
+    return [frames[request_key] for request_key in request_groups]
+
+def fetch_results(request_groups, api_key):
+    """Fetches every group of (url, sorted params) pairs in one batch, returning each group's decoded results or exceptions."""
+    # Identical requests (e.g. a serial pasted twice) are sent once and mapped back to each position.
+    unique = {}
+    for request_key in request_groups:
+        for key in request_key:
+            unique.setdefault(key, len(unique))
+    fetch_requests = [(url, dict(request_params)) for url, request_params in unique]
+
+    if len(fetch_requests) == 1:
+        url, request_params = fetch_requests[0]
+        try:
+            response = get_http_session(api_key).get(url, params=request_params, stream=True, timeout=60)
+            response.raise_for_status()
+            body = b"".join(response.iter_content(chunk_size=1 << 16))
+        except requests.exceptions.RequestException as e:
+            body = e
+        unique_results = [decode_body(body)]
+    else:
+        unique_results = asyncio.run(_gather(fetch_requests, api_headers(api_key)))
+
+    return [[unique_results[unique[key]] for key in request_key] for request_key in request_groups]
+
+def results_to_df(results):
+    """Concatenates decoded responses into one normalized DataFrame, collecting any API-level or request errors."""
+    data = []
+    api_errors = []
+    for result in results:
+        if isinstance(result, Exception):
+            api_errors.extend(request_error_messages(result))
+        elif isinstance(result, dict) and 'error-code' in result:
+            api_errors.append(f"API Error {result.get('error-code')}: {result.get('message')}")
+        elif isinstance(result, list):
+            data.extend(result)
+        elif result:
+            data.append(result)
+
+    if not data:
+        return pd.DataFrame(), api_errors
+
+    # json_normalize only flattens nested dicts; flat records can skip its per-value walk.
+    if all(isinstance(record, dict) and not any(isinstance(value, dict) for value in record.values()) for record in data):
+        df = pd.DataFrame.from_records(data)
+    else:
+        df = pd.json_normalize(data)
+
+    df = downcast_numeric(df)
+
+    # Add a readable datetime column for every numeric time/date/epoch column in one concat.
+    time_cols = df.columns[df.columns.str.contains('time|date|epoch', regex=True)]
+    epoch_cols = time_cols.intersection(df.select_dtypes('number').columns)
+    if not epoch_cols.empty:
+        readable = df[epoch_cols].apply(pd.to_datetime, unit='s', errors='coerce').add_suffix('_readable')
+        df = pd.concat([df, readable], axis=1)
+
+    return df, api_errors
+
+def build_fetch_requests(endpoint_name, serials, params):
+    """Expands one endpoint's inputs into the list of (url, params) pairs to request."""
+    endpoint = ENDPOINTS[endpoint_name]
+    endpoint_params = {key: params[key] for param in endpoint["params"]
+                       for key in PARAM_KEYS.get(param, ()) if key in params}
+
+    # One request per serial; the Devices endpoint takes the serial as a query parameter.
+    endpoint_url = f"{BASE_URL}{endpoint['path']}"
+    if endpoint_name not in ["Devices"]:
+        fetch_requests = [(f"{endpoint_url}{sid}", endpoint_params) for sid in serials]
+    elif serials:
+        fetch_requests = [(endpoint_url, {**endpoint_params, 'device_serialid': sid}) for sid in serials]
+    else:
+        fetch_requests = [(endpoint_url, endpoint_params)]
+
+    # Split long windows into back-to-back sub-windows that are fetched concurrently.
+    window = WINDOW_SECONDS.get(endpoint_params.get('granularity'))
+    if endpoint.get("split_windows") and window:
+        fetch_requests = [
+            (url, {**request_params, 'starttime': window_start,
+                   'endtime': min(window_start + window - 1, request_params['endtime'])})
+            for url, request_params in fetch_requests
+            for window_start in range(request_params['starttime'], request_params['endtime'] + 1, window)
+        ]
+    return fetch_requests
+
+def to_parquet_bytes(df):
+    """Encodes the DataFrame as a ZSTD-compressed Parquet file, or returns None if Arrow cannot convert it."""
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        buffer = io.BytesIO()
+        pa.parquet.write_table(table, buffer, compression='zstd')
+        return buffer.getvalue()
+    except pa.ArrowException as e:
+        log_error(f"Parquet export skipped: {e}")
+        return None
+
+def downcast_numeric(df):
+    """Narrows numeric columns to the smallest dtype that still holds every value exactly."""
+    narrowed = {}
+    for col in df.select_dtypes('integer').columns:
+        narrowed[col] = pd.to_numeric(df[col], downcast='integer')
+    # pandas always downcasts floats to float32, so only keep it when no precision is lost.
+    for col in df.select_dtypes('floating').columns:
+        as_float32 = df[col].astype('float32')
+        if as_float32.astype('float64').equals(df[col]):
+            narrowed[col] = as_float32
+    return df.assign(**narrowed) if narrowed else df
+
+@functools.lru_cache(maxsize=64)
+def query_hash(request_key):
+    """Returns a stable hash of the request set, used to key the cached CSV downloads."""
+    return hashlib.blake2b(json.dumps(request_key, sort_keys=True).encode()).hexdigest()
+
+def to_csv_bytes(df):
+    """Encodes the DataFrame as UTF-8 CSV bytes using Arrow's columnar CSV writer."""
+    # json_normalize leaves list and dict values in place; render them as pandas would so Arrow can write them.
+    nested = {}
+    for col in df.columns[df.dtypes == object]:
+        is_nested = df[col].map(lambda value: isinstance(value, (list, dict)))
+        if is_nested.any():
+            nested[col] = df[col].mask(is_nested, df[col][is_nested].map(str))
+    if nested:
+        df = df.assign(**nested)
+
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        buffer = io.BytesIO()
+        pa.csv.write_csv(table, buffer)
+        return buffer.getvalue()
+    except pa.ArrowException:
+        # Mixed-type columns that Arrow cannot convert go through pandas instead.
+        return df.to_csv(index=False).encode('utf-8')
+
 def logout():
     """Callback function to reset login state."""
     st.session_state.logged_in = False
-    st.rerun()
+    if "http" in st.session_state:
+        st.session_state.pop("http").close()
+    for key in [key for key in st.session_state if key.startswith("csv::")]:
+        del st.session_state[key]
 
 # --- Login Logic ---
-if not st.session_state.logged_in:
+def _password_digest(password):
+    """Returns a fixed-length digest of the password for constant-time comparison."""
+    return hashlib.blake2b(password.encode(), digest_size=32).digest()
+
+@st.cache_resource
+def _credential_map():
+    """Pairs each configured username with the digest of its own password."""
+    credentials = st.secrets["credentials"]
+    return {username: _password_digest(password)
+            for username, password in zip(credentials["usernames"], credentials["passwords"])}
+
+def login():
+    """Form callback that checks the credentials before the submit rerun starts."""
+    username = st.session_state.login_username
+    password = st.session_state.login_password
+    # More robust check for secrets configuration
+    if "credentials" not in st.secrets:
+        st.session_state.login_error = "Missing [credentials] section in your secrets.toml file."
+    elif "usernames" not in st.secrets["credentials"] or "passwords" not in st.secrets["credentials"]:
+        st.session_state.login_error = "Missing 'usernames' or 'passwords' under [credentials] in your secrets.toml file."
+    else:
+        try:
+            stored_digest = _credential_map().get(username)
+            if (stored_digest is not None and
+                hmac.compare_digest(stored_digest, _password_digest(password))):
+                # The rerun triggered by the submit itself renders the downloader view.
+                st.session_state.logged_in = True
+            else:
+                st.session_state.login_error = "Incorrect username or password"
+        except Exception as e:
+            error_msg = f"An error occurred while reading secrets: {e}"
+            log_error(error_msg)
+            st.session_state.login_error = error_msg
+
+def login_view():
+    """Renders the login form and any error from the last attempt."""
     st.title("Edge API Data Downloader")
     
     with st.form("login_form"):
-        username = st.text_input("Username")
-        password = st.text_input("Password", type="password")
-        submitted = st.form_submit_button("Login")
-
-        if submitted:
-            # More robust check for secrets configuration
-            if "credentials" not in st.secrets:
-                st.error("Missing [credentials] section in your secrets.toml file.")
-            elif "usernames" not in st.secrets["credentials"] or "passwords" not in st.secrets["credentials"]:
-                st.error("Missing 'usernames' or 'passwords' under [credentials] in your secrets.toml file.")
-            else:
-                try:
-                    if (username in st.secrets["credentials"]["usernames"] and
-                        password in st.secrets["credentials"]["passwords"]):
-                        st.session_state.logged_in = True
-                        st.rerun()
-                    else:
-                        st.error("Incorrect username or password")
-                except Exception as e:
-                    error_msg = f"An error occurred while reading secrets: {e}"
-                    log_error(error_msg)
-                    st.error(error_msg)
+        st.text_input("Username", key="login_username")
+        st.text_input("Password", type="password", key="login_password")
+        st.form_submit_button("Login", on_click=login)
+
+        if "login_error" in st.session_state:
+            st.error(st.session_state.pop("login_error"))
 
 # --- Main Application ---
-if st.session_state.logged_in:
+@st.fragment
+def downloader_view(selected_endpoint_names):
+    """Renders the inputs and fetch logic; widget changes only re-run this fragment."""
     st.title("Edge API Data Downloader")
     st.write("This app fetches data from the Edge API and allows you to download it as a CSV file.")
 
-    # --- Sidebar Configuration ---
-    st.sidebar.header("Endpoint Selection")
+    if not selected_endpoint_names:
+        st.info("Select one or more endpoints in the sidebar to get started.")
+        return
 
-    endpoints = {
-        "Devices": {
-            "path": "/devices",
-            "description": "Returns device details based on the API Key and optional device serial ID.",
-            "params": ["device_serialid"],
-            "required_params": [] 
-        },
-        "Events Interval": {
-            "path": "/events/interval/",
-            "description": "Returns event details based on the device_serialid provided within the time stamps.",
-            "params": ["device_serialid", "dates"],
-            "required_params": ["device_serialid"]
-        },
-        "Power Quality Live": {
-            "path": "/powerquality/live/",
-            "description": "Returns live power quality based on the serialid provided.",
-            "params": ["device_serialid"],
-            "required_params": ["device_serialid"]
-        },
-        "Power Quality Interval": {
-            "path": "/powerquality/interval/",
-            "description": "Returns power quality data based on the provided serialid and the time stamps.",
-            "params": ["device_serialid", "dates", "granularity"],
-            "required_params": ["device_serialid", "granularity"]
-        },
-        "Power Quality Aggregated": {
-            "path": "/powerquality/aggregated/",
-            "description": "Returns aggregated power quality data based on the provided serialid and the time stamps.",
-            "params": ["device_serialid", "dates", "granularity"],
-            "required_params": ["device_serialid", "granularity"]
-        }
-    }
-
-    selected_endpoint_name = st.sidebar.selectbox("Choose an API endpoint", list(endpoints.keys()))
-    st.sidebar.write("---")
-    st.sidebar.button("Logout", on_click=logout)
+    selected_endpoints = [ENDPOINTS[name] for name in selected_endpoint_names]
+    for name, endpoint in zip(selected_endpoint_names, selected_endpoints):
+        st.info(f"**{name}:** {endpoint['description']}")
 
-    selected_endpoint = endpoints[selected_endpoint_name]
-    st.info(f"**Description:** {selected_endpoint['description']}")
+    # Inputs are shown once and shared by every selected endpoint that takes them.
+    input_params = {param for endpoint in selected_endpoints for param in endpoint["params"]}
+    required_params = {param for endpoint in selected_endpoints for param in endpoint["required_params"]}
 
     # --- Dynamic Input Parameters ---
     st.header("Input Parameters")
     params = {}
-    base_url = "https://v3.edgezeroapi.com/pienergy"
-    full_url = ""
-    device_serialid = ""
+    serials = []
+    fetch_disabled = False
 
-    if "device_serialid" in selected_endpoint["params"]:
-        label = "Device Serial ID"
-        if "device_serialid" not in selected_endpoint["required_params"]:
+    if "device_serialid" in input_params:
+        label = "Device Serial ID(s)"
+        if "device_serialid" not in required_params:
             label += " (Optional)"
-        device_serialid = st.text_input(label, "EXXXXXXXXXXXX")
-        
-        if selected_endpoint_name not in ["Devices"]:
-            full_url = f"{base_url}{selected_endpoint['path']}{device_serialid}"
-        else:
-            full_url = f"{base_url}{selected_endpoint['path']}"
-            if device_serialid:
-                 params['device_serialid'] = device_serialid
-
-    if "dates" in selected_endpoint["params"]:
+        device_serialid = st.text_input(label, "EXXXXXXXXXXXX", help="Separate multiple serial IDs with commas.")
+        serials = [sid.strip() for sid in device_serialid.split(",") if sid.strip()]
+
+    if "dates" in input_params:
         col1, col2 = st.columns(2)
         with col1:
             start_date = st.date_input("Start Date", datetime.now().date())
@@ -133,31 +462,50 @@ if st.session_state.logged_in:
             params['endtime'] = int(end_dt_utc.timestamp())
             st.caption(f"Epoch: {params['endtime']}")
     
-    if "granularity" in selected_endpoint["params"]:
+    if "granularity" in input_params:
         if 'start_date' in locals() and 'end_date' in locals():
             date_range_days = (end_date - start_date).days
-
-            granularity_options = []
-            if date_range_days < 1:
-                granularity_options = ["1m", "5m", "15m", "1h", "daily"]
-            elif 1 <= date_range_days <= 7:
-                granularity_options = ["15m", "1h", "daily"]
-            else:
-                granularity_options = ["1h", "daily"]
-                
+            tier = bisect.bisect_right(GRANULARITY_THRESHOLDS, max(date_range_days, 0)) - 1
+            granularity_options = GRANULARITY_TIERS[tier][1]
             params['granularity'] = st.selectbox("Granularity", granularity_options)
 
+            # The date range is inclusive, so a single day still covers one full day of rows.
+            granularity_endpoints = sum("granularity" in endpoint["params"] for endpoint in selected_endpoints)
+            expected_rows = ((date_range_days + 1) * ROWS_PER_DAY[params['granularity']]
+                             * max(len(serials), 1) * granularity_endpoints)
+            if expected_rows > MAX_EXPECTED_ROWS:
+                st.warning(
+                    f"This request would return roughly {expected_rows:,} rows, above the {MAX_EXPECTED_ROWS:,} row limit. "
+                    "Please choose a smaller date range or a coarser granularity."
+                )
+                fetch_disabled = True
+
+    # --- Request Construction ---
+    request_keys = {}
+    download_keys = {}
+    for name in selected_endpoint_names:
+        fetch_requests = build_fetch_requests(name, serials, params)
+        request_keys[name] = tuple((url, tuple(sorted(request_params.items()))) for url, request_params in fetch_requests)
+        download_keys[name] = f"csv::{query_hash(request_keys[name])}"
 
     # --- Data Fetching Logic ---
-    if st.button(f"Fetch Data from '{selected_endpoint_name}'"):
+    force_refresh = st.checkbox("Force refresh", help="Ignore cached results for this fetch and query the Edge API again.")
+    endpoint_labels = ", ".join(f"'{name}'" for name in selected_endpoint_names)
+    fetched = {}
+    if st.button(f"Fetch Data from {endpoint_labels}", disabled=fetch_disabled):
         validation_passed = True
-        for param in selected_endpoint.get("required_params", []):
-            if param == 'device_serialid' and not device_serialid:
-                error_msg = "Device Serial ID is a required parameter for this endpoint."
+        for name, endpoint in zip(selected_endpoint_names, selected_endpoints):
+            if 'device_serialid' in endpoint["required_params"] and not serials:
+                error_msg = f"Device Serial ID is a required parameter for '{name}'."
                 log_error(error_msg)
                 st.error(error_msg)
                 validation_passed = False
 
+        # A Fetch click always goes through fetch_dfs, whose cache TTL decides whether the API is hit;
+        # the stored downloads only serve the reruns started by the download buttons.
+        for key in [key for key in st.session_state if key.startswith("csv::")]:
+            del st.session_state[key]
+
         if validation_passed:
             try:
                 if "edgeapi" not in st.secrets or "api_key" not in st.secrets["edgeapi"]:
@@ -167,54 +515,74 @@ if st.session_state.logged_in:
                     st.stop()
                 
                 api_key = st.secrets["edgeapi"]["api_key"]
-                
+
                 with st.spinner("Fetching data from Edge API..."):
-                    headers = {"X-Api-Key": api_key, "accept": "*/*"}
-                    response = requests.get(full_url, headers=headers, params=params)
-                    response.raise_for_status()
-                    data = response.json()
+                    cache_ttls = [ENDPOINTS[name].get("cache_ttl", CACHE_TTL_SECONDS) for name in selected_endpoint_names]
+                    frames = fetch_dfs([request_keys[name] for name in selected_endpoint_names], api_key, cache_ttls, force_refresh)
 
-                if isinstance(data, dict) and 'error-code' in data:
-                    error_msg = f"API Error {data.get('error-code')}: {data.get('message')}"
+                for name, (df, api_errors) in zip(selected_endpoint_names, frames):
+                    fetched[name] = (df, api_errors)
+                    if not df.empty:
+                        csv = to_csv_bytes(df)
+                        filename = f"{name.replace(' ', '_').lower()}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+                        parquet = to_parquet_bytes(df) if ENDPOINTS[name].get("parquet_download") else None
+                        st.session_state[download_keys[name]] = (csv, parquet, filename)
+
+            # Failed requests are reported inside their endpoint's results; this only catches the unexpected.
+            except Exception as e:
+                error_msg = f"An unexpected error occurred: {e}"
+                log_error(error_msg)
+                st.error(error_msg)
+
+    # --- Results ---
+    # The download buttons rerun the script, so they are served from the cached bytes.
+    for name in selected_endpoint_names:
+        download_key = download_keys[name]
+        if name not in fetched and download_key not in st.session_state:
+            continue
+
+        with st.expander(name, expanded=True):
+            if name in fetched:
+                df, api_errors = fetched[name]
+                for error_msg in api_errors:
                     log_error(error_msg)
                     st.error(error_msg)
-                elif not data:
-                    st.info("The API returned no data for the given parameters.")
+
+                if df.empty:
+                    if not api_errors:
+                        st.info("The API returned no data for the given parameters.")
                 else:
                     st.success("Data fetched successfully!")
-                    df = pd.json_normalize(data)
 
-                    for col in df.columns:
-                        if 'time' in col or 'date' in col or 'epoch' in col:
-                            if pd.api.types.is_numeric_dtype(df[col]):
-                                df[f'{col}_readable'] = pd.to_datetime(df[col], unit='s', errors='coerce')
-
-                    csv = df.to_csv(index=False).encode('utf-8')
-                    filename = f"{selected_endpoint_name.replace(' ', '_').lower()}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+            if download_key in st.session_state:
+                csv, parquet, filename = st.session_state[download_key]
+                st.download_button(
+                    label="Download data as CSV",
+                    data=csv,
+                    file_name=filename,
+                    mime='text/csv',
+                    key=f"download_csv_{name}",
+                )
+                if parquet is not None:
                     st.download_button(
-                        label="Download data as CSV",
-                        data=csv,
-                        file_name=filename,
-                        mime='text/csv',
+                        label="Download data as Parquet",
+                        data=parquet,
+                        file_name=filename.replace('.csv', '.parquet'),
+                        mime='application/octet-stream',
+                        key=f"download_parquet_{name}",
                     )
-            
-            except requests.exceptions.HTTPError as e:
-                error_msg = f"HTTP Error: {e}"
-                log_error(error_msg)
-                st.error(error_msg)
-                try:
-                    error_json = e.response.json()
-                    api_message = error_json.get('message', e.response.text)
-                    api_response_error = f"API Response: {api_message}"
-                    log_error(api_response_error)
-                    st.error(api_response_error)
-                except json.JSONDecodeError:
-                    api_response_error = f"API Response: {e.response.text}"
-                    log_error(api_response_error)
-                    st.error(api_response_error)
-                except Exception:
-                    pass
-            except Exception as e:
-                error_msg = f"An unexpected error occurred: {e}"
-                log_error(error_msg)
-                st.error(error_msg)
+
+if not st.session_state.logged_in:
+    login_view()
+else:
+    # --- Sidebar Configuration ---
+    # Fragments cannot write to the sidebar, so it is rendered by the full script run.
+    st.sidebar.header("Endpoint Selection")
+
+    selected_endpoint_names = st.sidebar.multiselect("Choose API endpoints", list(ENDPOINTS.keys()), default=["Devices"])
+    st.sidebar.write("---")
+    st.sidebar.button("Logout", on_click=logout)
+
+    pd = _pd()
+    pa = _pa()
+    downloader_view(selected_endpoint_names)